@@ -1,9 +1,9 @@
 import streamlit as st
 import time
 import pandas as pd
-import glob
 import re
 import os
+from os.path import basename
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -14,6 +14,9 @@ from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
 from langchain_groq import ChatGroq
 import chromadb
+import torch
+
+from OnnxEmbeddings import ONNXEmbeddings
 
 load_dotenv()
 
@@ -26,8 +29,38 @@ st.set_page_config(
 )
 
 # --- FUNÇÕES DE BACKEND ---
+_ANO_RE = re.compile(r"(201[2-9]|202[0-9])")
+
+# Classificação por extensão via dict module-level: lookup O(1) e nenhuma
+# lista alocada por iteração no walk da pasta de dados
+_EXT_KIND = {".pdf": "PDF", ".csv": "CSV", ".docx": "DOC", ".doc": "DOC", ".txt": "DOC"}
+
+def _listar_arquivos(raiz):
+    """Varredura recursiva com os.scandir (um readdir por pasta, sem fnmatch)."""
+    achados = []
+    pilha = [raiz]
+    while pilha:
+        try:
+            with os.scandir(pilha.pop()) as it:
+                for entrada in it:
+                    if entrada.is_dir(follow_symlinks=False):
+                        pilha.append(entrada.path)
+                    elif entrada.is_file():
+                        achados.append(entrada.path)
+        except OSError:
+            pass
+    return achados
+
+@st.cache_resource
+def _chroma_client():
+    """Cliente Chroma único por processo: recarregar os segmentos HNSW do disco
+    a cada rerun da sidebar é caro; cache_resource mantém o handle aberto."""
+    return chromadb.PersistentClient(path="./chroma_db_cache")
+
 @st.cache_data(ttl=60)
-def carregar_metricas():
+def carregar_metricas(mtime_dados):
+    # mtime_dados entra na chave do cache: mudou a pasta, invalida na hora;
+    # caso contrário o walk só roda quando o TTL expira
     stats = {
         "total_arquivos": 0,
         "tipos": {"PDF": 0, "CSV": 0, "DOC": 0},
@@ -36,54 +69,69 @@ def carregar_metricas():
     }
     
     if os.path.exists("./dados"):
-        arquivos = glob.glob("./dados/**/*.*", recursive=True)
+        arquivos = _listar_arquivos("./dados")
         stats["total_arquivos"] = len(arquivos)
         
         for f in arquivos:
             ext = os.path.splitext(f)[1].lower()
-            if ext == ".pdf": stats["tipos"]["PDF"] += 1
-            elif ext == ".csv": stats["tipos"]["CSV"] += 1
-            elif ext in [".docx", ".doc", ".txt"]: stats["tipos"]["DOC"] += 1
-            
-            match = re.search(r"(201[2-9]|202[0-9])", os.path.basename(f))
+            tipo = _EXT_KIND.get(ext)
+            if tipo: stats["tipos"][tipo] += 1
+
+            match = _ANO_RE.search(os.path.basename(f))
             if match: stats["anos"].add(int(match.group(0)))
     
     try:
-        client = chromadb.PersistentClient(path="./chroma_db_cache")
-        stats["vetores"] = client.get_collection("langchain").count()
+        stats["vetores"] = _chroma_client().get_collection("langchain").count()
     except:
         stats["vetores"] = 0
 
     return stats
 
 @st.cache_resource
+def _get_embeddings():
+    # GPU + FP16 quando disponível reduz a latência do embedding da pergunta;
+    # sem GPU, usa o modelo ONNX quantizado (INT8) para acelerar na CPU
+    if torch.cuda.is_available():
+        embeddings = HuggingFaceEmbeddings(
+            model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+            model_kwargs={"device": "cuda"},
+            encode_kwargs={"normalize_embeddings": True},
+        )
+        embeddings.client.half()
+        return embeddings
+    return ONNXEmbeddings("sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+
+@st.cache_resource
+def _get_chain(_embeddings):
+    # O prefixo _ diz ao Streamlit para não hashear o modelo a cada rerun —
+    # é justamente esse hashing que domina o custo do cache com objetos de ML
+    vectorstore = Chroma(persist_directory="./chroma_db_cache", embedding_function=_embeddings)
+    retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 4})
+    llm = ChatGroq(model="llama-3.1-8b-instant", temperature=0)
+
+    template = """
+    Use o contexto abaixo para responder a pergunta.
+    Se não souber, diga "Sem dados".
+
+    CONTEXTO:
+    {context}
+
+    PERGUNTA:
+    {question}
+
+    RESPOSTA TÉCNICA:
+    """
+
+    return RetrievalQA.from_chain_type(
+        llm=llm,
+        retriever=retriever,
+        return_source_documents=True,
+        chain_type_kwargs={"prompt": PromptTemplate.from_template(template)}
+    )
+
 def setup_rag():
     try:
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
-        vectorstore = Chroma(persist_directory="./chroma_db_cache", embedding_function=embeddings)
-        retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 4})
-        llm = ChatGroq(model="llama-3.1-8b-instant", temperature=0)
-
-        template = """
-        Use o contexto abaixo para responder a pergunta. 
-        Se não souber, diga "Sem dados".
-        
-        CONTEXTO:
-        {context}
-        
-        PERGUNTA: 
-        {question}
-        
-        RESPOSTA TÉCNICA:
-        """
-        
-        chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            retriever=retriever,
-            return_source_documents=True,
-            chain_type_kwargs={"prompt": PromptTemplate.from_template(template)}
-        )
-        return chain, "Operacional"
+        return _get_chain(_get_embeddings()), "Operacional"
     except Exception as e:
         return None, f"Erro: {str(e)}"
 
@@ -95,7 +143,7 @@ if "messages" not in st.session_state:
     st.session_state.messages = []
 
 # --- INICIALIZAÇÃO ---
-metricas = carregar_metricas()
+metricas = carregar_metricas(os.path.getmtime("./dados") if os.path.exists("./dados") else 0.0)
 qa_chain, status_msg = setup_rag()
 
 # --- SIDEBAR (MÉTRICAS) ---
@@ -155,7 +203,8 @@ with tab_chat:
                         res = qa_chain.invoke({"query": prompt})
                         resposta = res['result']
                         docs = res.get('source_documents', [])
-                        fontes_nomes = list(set([os.path.basename(d.metadata.get('source', '')) for d in docs]))
+                        # Uma passada, uma alocação: set comprehension direto (fontes vazias fora)
+                        fontes_nomes = tuple({basename(d.metadata['source']) for d in docs if d.metadata.get('source')})
                         
                         status_box.update(label="Processamento concluído!", state="complete", expanded=False)
                         
@@ -181,12 +230,15 @@ with tab_chat:
                         st.error(str(e))
 
 # --- ABA 2: LOGS ---
-with tab_logs:
+@st.fragment
+def _render_logs():
+    # Fragment: a tabela só é reconstruída/serializada quando o próprio
+    # fragmento reroda, não a cada interação do chat
     st.markdown("### Histórico de Execução (Sessão Atual)")
-    
+
     if st.session_state["logs_execucao"]:
         df_logs = pd.DataFrame(st.session_state["logs_execucao"])
-        
+
         st.dataframe(
             df_logs,
             use_container_width=True,
@@ -199,9 +251,12 @@ with tab_logs:
                 "Latência": st.column_config.TextColumn("Tempo", width="small"),
             }
         )
-        
+
         if st.button("Limpar Tabela de Logs"):
             st.session_state["logs_execucao"] = []
             st.rerun()
     else:
-        st.info("Nenhuma interação registrada ainda.")
\ No newline at end of file
+        st.info("Nenhuma interação registrada ainda.")
+
+with tab_logs:
+    _render_logs()
\ No newline at end of file